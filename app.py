@@ -1,14 +1,21 @@
 import streamlit as st
 import os
 import time
+import asyncio
+import threading
 import logging
 import json
-from typing import Dict, List, Optional, Any
+from collections import OrderedDict, deque
+from typing import Dict, Iterator, List, Optional, Any, Tuple, Union
 from dataclasses import dataclass, asdict
-from dotenv import load_dotenv
 from google import genai
 from google.genai.errors import ClientError
 
+try:
+    import orjson
+except ImportError:  # Optional faster JSON encoder
+    orjson = None
+
 # ============================================================================
 # LOGGING CONFIGURATION
 # ============================================================================
@@ -46,6 +53,23 @@ class TechniqueKeys:
     NEGATIVE = 'negative'
     NEGATIVE_DETAILS = 'negative_details'
 
+# Free-text keys that accompany a technique rather than toggling one
+_DETAIL_KEYS = frozenset({
+    TechniqueKeys.FORMAT_DETAILS,
+    TechniqueKeys.ITERATE_INSTRUCTIONS,
+    TechniqueKeys.NEGATIVE_DETAILS
+})
+
+# Display names for the "Active Techniques" badges
+_TECHNIQUE_NAMES = {
+    TechniqueKeys.ROLE: '1️⃣ Role',
+    TechniqueKeys.COT: '2️⃣ Chain-of-Thought',
+    TechniqueKeys.FORMAT: '3️⃣ Format',
+    TechniqueKeys.CONTEXT: '4️⃣ Context',
+    TechniqueKeys.ITERATE: '5️⃣ Iteration',
+    TechniqueKeys.NEGATIVE: '6️⃣ Negative'
+}
+
 # Available models
 MODELS = {
     "Gemini 2.5 Flash (Fast)": "gemini-2.5-flash",
@@ -53,6 +77,90 @@ MODELS = {
     "Gemini 1.5 Pro (Most Capable)": "gemini-1.5-pro"
 }
 
+# Reuse identical Gemini responses for up to an hour
+RESPONSE_CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 128
+
+# Client-side API rate limit (token bucket)
+RATE_LIMIT_PER_SECOND = 1.0
+RATE_LIMIT_BURST = 3
+
+# Temperatures used by "Generate 3 Variations", in display order
+VARIATION_TEMPERATURES = (0.7, 1.0, 1.5)
+
+# Custom page styling, injected by load_custom_css()
+_CUSTOM_CSS = """
+<style>
+    /* Main Header - Responsive Font Size */
+    .main-header {
+        font-size: 2.5rem;
+        font-weight: 700;
+        background: linear-gradient(90deg, #FF4B4B 0%, #FF8E53 100%);
+        -webkit-background-clip: text;
+        -webkit-text-fill-color: transparent;
+        margin-bottom: 0.5rem;
+    }
+    @media (max-width: 768px) {
+        .main-header {
+            font-size: 1.8rem;
+        }
+    }
+
+    /* Subtitle - Responsive Font Size */
+    .subtitle {
+        font-size: 1.1rem;
+        color: var(--text-color);
+        opacity: 0.8;
+        margin-bottom: 2rem;
+    }
+    @media (max-width: 768px) {
+        .subtitle {
+            font-size: 0.9rem;
+            margin-bottom: 1.5rem;
+        }
+    }
+
+    /* Text Area Font */
+    .stTextArea textarea {
+        font-family: 'Monaco', 'Menlo', 'Courier New', monospace;
+    }
+
+    /* Example Box - Theming Support */
+    .example-box {
+        background-color: var(--secondary-background-color);
+        padding: 1rem;
+        border-radius: 0.5rem;
+        border-left: 3px solid #FF4B4B;
+        margin: 0.5rem 0;
+    }
+
+    /* Stat Row - Lays out the stat boxes side by side */
+    .stat-row {
+        display: flex;
+        gap: 1rem;
+    }
+
+    /* Stat Box - Theming Support */
+    .stat-box {
+        background-color: var(--secondary-background-color);
+        padding: 0.75rem;
+        border-radius: 0.5rem;
+        text-align: center;
+        border: 1px solid rgba(128, 128, 128, 0.2);
+    }
+
+    /* Technique Box - Theming Support */
+    .technique-box {
+        background-color: var(--secondary-background-color);
+        padding: 0.5rem;
+        border-radius: 0.3rem;
+        margin: 0.3rem 0;
+        border-left: 2px solid #4CAF50;
+        border: 1px solid rgba(128, 128, 128, 0.2);
+    }
+</style>
+"""
+
 # ============================================================================
 # DATA CLASSES
 # ============================================================================
@@ -67,6 +175,30 @@ class PresetConfig:
     iterate: bool = False
     negative: bool = False
 
+@dataclass
+class SidebarConfig:
+    """Settings chosen in the sidebar, shared with the main content."""
+    model_name: str
+    model_id: str
+    temperature: float
+    role_persona: str
+    tone_style: str
+
+@dataclass(slots=True)
+class Techniques:
+    """Validated technique settings; field names match TechniqueKeys values."""
+    role: bool = False
+    cot: bool = False
+    format: bool = False
+    format_details: str = ''
+    context: bool = False
+    iterate: bool = False
+    iterate_instructions: str = ''
+    negative: bool = False
+    negative_details: str = ''
+
+_TECHNIQUE_FIELDS = frozenset(Techniques.__dataclass_fields__)
+
 # Preset configurations for beginners
 PRESETS: Dict[str, Optional[PresetConfig]] = {
     "Custom (Manual)": None,
@@ -80,9 +212,6 @@ PRESETS: Dict[str, Optional[PresetConfig]] = {
 # CONFIGURATION & SETUP
 # ============================================================================
 
-# Load environment variables
-load_dotenv()
-
 def get_api_key() -> Optional[str]:
     """Get API key from Streamlit secrets (cloud) or environment (local)."""
     # Try Streamlit secrets first (for cloud deployment)
@@ -91,7 +220,11 @@ def get_api_key() -> Optional[str]:
             return st.secrets['GEMINI_API_KEY']
     except (FileNotFoundError, KeyError):
         pass
-    # Fall back to environment variable (for local development)
+    # Fall back to environment variable (for local development), loading
+    # the .env file only when the key is not already set
+    if 'GEMINI_API_KEY' not in os.environ:
+        from dotenv import load_dotenv
+        load_dotenv()
     return os.getenv('GEMINI_API_KEY')
 
 @st.cache_resource
@@ -116,104 +249,134 @@ if not api_key or api_key == "YOUR_API_KEY_HERE" or api_key == "your_actual_api_
 # Initialize Gemini client (cached)
 client = initialize_gemini_client(api_key)
 
-# ============================================================================
-# HELPER FUNCTIONS
-# ============================================================================
+async def _gather_gemini(prompt: str, model_id: str, temps: Tuple[float, ...]) -> List[Any]:
+    """Send one request per temperature concurrently on the async client.
 
-def load_custom_css() -> None:
-    """Load custom CSS styling."""
-    css = """
-    <style>
-        /* Main Header - Responsive Font Size */
-        .main-header {
-            font-size: 2.5rem;
-            font-weight: 700;
-            background: linear-gradient(90deg, #FF4B4B 0%, #FF8E53 100%);
-            -webkit-background-clip: text;
-            -webkit-text-fill-color: transparent;
-            margin-bottom: 0.5rem;
-        }
-        @media (max-width: 768px) {
-            .main-header {
-                font-size: 1.8rem;
-            }
-        }
+    Returns the response text (``None`` if empty), or the raised exception,
+    for each temperature. The requests run concurrently but each opens its
+    own HTTP/1.1 connection. A fresh client is used per batch because
+    ``asyncio.run`` closes its event loop afterwards, so it is closed again
+    before the loop goes away.
+    """
+    batch_client = genai.Client(api_key=api_key)
+    aio = batch_client.aio
+    
+    async def _gen(temp: float) -> str:
+        response = await aio.models.generate_content(
+            model=model_id,
+            contents=prompt,
+            config={'temperature': temp}
+        )
+        return response.text
+    
+    try:
+        return await asyncio.gather(*(_gen(t) for t in temps), return_exceptions=True)
+    finally:
+        await aio.aclose()
+        batch_client.close()
 
-        /* Subtitle - Responsive Font Size */
-        .subtitle {
-            font-size: 1.1rem;
-            color: var(--text-color);
-            opacity: 0.8;
-            margin-bottom: 2rem;
-        }
-        @media (max-width: 768px) {
-            .subtitle {
-                font-size: 0.9rem;
-                margin-bottom: 1.5rem;
-            }
-        }
+@st.cache_resource
+def _response_cache() -> "OrderedDict[Tuple[str, str, float], Tuple[float, str]]":
+    """Shared store of recent responses, keyed by (model, prompt, temperature).
 
-        /* Text Area Font */
-        .stTextArea textarea {
-            font-family: 'Monaco', 'Menlo', 'Courier New', monospace;
-        }
+    ``st.cache_data`` cannot be populated from a streamed response, so the
+    cache is kept as a resource and filled once streaming completes. Entries
+    are ordered oldest first; guard every access with ``_response_cache_lock``.
+    """
+    return OrderedDict()
 
-        /* Example Box - Theming Support */
-        .example-box {
-            background-color: var(--secondary-background-color);
-            padding: 1rem;
-            border-radius: 0.5rem;
-            border-left: 3px solid #FF4B4B;
-            margin: 0.5rem 0;
-        }
+@st.cache_resource
+def _response_cache_lock() -> threading.Lock:
+    """Lock shared by all sessions for access to the response cache."""
+    return threading.Lock()
 
-        /* Stat Box - Theming Support */
-        .stat-box {
-            background-color: var(--secondary-background-color);
-            padding: 0.75rem;
-            border-radius: 0.5rem;
-            text-align: center;
-            border: 1px solid rgba(128, 128, 128, 0.2);
-        }
+def _evict_expired_responses(cache: "OrderedDict[Tuple[str, str, float], Tuple[float, str]]", now: float) -> None:
+    """Drop entries older than the TTL; the caller must hold the lock."""
+    while cache:
+        key, (stored_at, _) = next(iter(cache.items()))
+        if now - stored_at <= RESPONSE_CACHE_TTL:
+            break
+        del cache[key]
 
-        /* Technique Box - Theming Support */
-        .technique-box {
-            background-color: var(--secondary-background-color);
-            padding: 0.5rem;
-            border-radius: 0.3rem;
-            margin: 0.3rem 0;
-            border-left: 2px solid #4CAF50;
-            border: 1px solid rgba(128, 128, 128, 0.2);
-        }
-    </style>
+def get_cached_response(model_id: str, prompt: str, temp: float) -> Optional[str]:
+    """Return a previously generated response if it is still fresh."""
+    cache = _response_cache()
+    with _response_cache_lock():
+        _evict_expired_responses(cache, time.monotonic())
+        entry = cache.get((model_id, prompt, temp))
+    return entry[1] if entry is not None else None
+
+def cache_response(model_id: str, prompt: str, temp: float, text: str) -> None:
+    """Store a generated response, evicting expired and excess entries."""
+    cache = _response_cache()
+    key = (model_id, prompt, temp)
+    with _response_cache_lock():
+        now = time.monotonic()
+        cache[key] = (now, text)
+        cache.move_to_end(key)
+        _evict_expired_responses(cache, now)
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def _stream_gemini(prompt: str, model_id: str, temp: float) -> Iterator[str]:
+    """Yield response text chunks from Gemini as they arrive."""
+    for chunk in client.models.generate_content_stream(
+        model=model_id,
+        contents=prompt,
+        config={'temperature': temp}
+    ):
+        if chunk.text:
+            yield chunk.text
+
+def _call_gemini_candidates(prompt: str, model_id: str, temp: float, count: int) -> List[str]:
+    """Request ``count`` candidate completions for one prompt in a single call.
+
+    The prompt is processed once and shared by every candidate. Candidates
+    that come back without content (e.g. blocked by safety filters) are skipped.
     """
-    st.markdown(css, unsafe_allow_html=True)
-
-def validate_techniques(techniques: Dict[str, Any]) -> Dict[str, Any]:
-    """Ensure technique dictionary has all required keys with defaults."""
-    defaults = {
-        TechniqueKeys.ROLE: False,
-        TechniqueKeys.COT: False,
-        TechniqueKeys.FORMAT: False,
-        TechniqueKeys.FORMAT_DETAILS: '',
-        TechniqueKeys.CONTEXT: False,
-        TechniqueKeys.ITERATE: False,
-        TechniqueKeys.ITERATE_INSTRUCTIONS: '',
-        TechniqueKeys.NEGATIVE: False,
-        TechniqueKeys.NEGATIVE_DETAILS: ''
-    }
-    return {**defaults, **techniques}
+    response = client.models.generate_content(
+        model=model_id,
+        contents=prompt,
+        config={'temperature': temp, 'candidate_count': count}
+    )
+    outputs = []
+    for candidate in response.candidates or []:
+        if candidate.content and candidate.content.parts:
+            outputs.append("".join(part.text or "" for part in candidate.content.parts))
+    return outputs
+
+# ============================================================================
+# HELPER FUNCTIONS
+# ============================================================================
+
+def load_custom_css() -> None:
+    """Load custom CSS styling.
+
+    Injected on every run: Streamlit removes elements that a rerun does not
+    emit again, so injecting only once per session would drop the styles.
+    """
+    st.markdown(_CUSTOM_CSS, unsafe_allow_html=True)
+
+def validate_techniques(techniques: Dict[str, Any]) -> Techniques:
+    """Convert a technique dictionary to Techniques, defaulting missing keys."""
+    return Techniques(**{k: v for k, v in techniques.items() if k in _TECHNIQUE_FIELDS})
 
 def sanitize_input(text: str, max_length: int = 10000) -> str:
     """Sanitize user input to prevent issues."""
     # Remove null bytes
     text = text.replace('\x00', '')
     # Limit length
-    if len(text) > max_length:
-        st.warning(f"⚠️ Input truncated to {max_length} characters")
-        text = text[:max_length]
-    return text.strip()
+    if len(text) <= max_length:
+        return text.strip()
+    st.warning(f"⚠️ Input truncated to {max_length} characters")
+    return text[:max_length].strip()
 
+@st.cache_data(max_entries=32, show_spinner=False)
+def _read_context(file_bytes: bytes) -> str:
+    """Decode an uploaded context file; cached on the file contents."""
+    return file_bytes.decode("utf-8", errors="replace")
+
+@st.cache_data(max_entries=128, show_spinner=False)
 def build_enhanced_prompt(
     raw_input: str, 
     techniques: Dict[str, Any], 
@@ -226,83 +389,103 @@ def build_enhanced_prompt(
     # Validate techniques dictionary
     techniques = validate_techniques(techniques)
     
-    prompt_parts: List[str] = []
-    
-    # Base instruction
-    prompt_parts.append("Create an enhanced, professional prompt based on the following specifications:")
-    prompt_parts.append("")
-    
-    # 1. Role Assignment
-    if techniques.get(TechniqueKeys.ROLE):
-        prompt_parts.append(f"**ROLE/EXPERTISE:** {role_persona}")
-        prompt_parts.append("")
-    
-    # 2. Context Setting
-    if techniques.get(TechniqueKeys.CONTEXT) and context_file_content and context_file_content != "No external context file was provided.":
-        prompt_parts.append("**CONTEXT:**")
-        prompt_parts.append(context_file_content)
-        prompt_parts.append("")
-    
-    # 3. Constraint & Format
-    if techniques.get(TechniqueKeys.FORMAT) and techniques.get(TechniqueKeys.FORMAT_DETAILS):
-        prompt_parts.append(f"**OUTPUT FORMAT:** {techniques[TechniqueKeys.FORMAT_DETAILS]}")
-        prompt_parts.append("")
-    
-    # 4. Tone/Style
-    prompt_parts.append(f"**TONE/STYLE:** {tone_style}")
-    prompt_parts.append("")
-    
-    # 5. Chain of Thought
-    if techniques.get(TechniqueKeys.COT):
-        prompt_parts.append("**REASONING:** Show your step-by-step thought process and reasoning before providing the final answer.")
-        prompt_parts.append("")
-    
-    # 6. Iteration & Critique (for refinement)
-    if techniques.get(TechniqueKeys.ITERATE) and techniques.get(TechniqueKeys.ITERATE_INSTRUCTIONS):
-        prompt_parts.append(f"**REFINEMENT INSTRUCTIONS:** {techniques[TechniqueKeys.ITERATE_INSTRUCTIONS]}")
-        prompt_parts.append("")
-    
-    # 7. Negative Constraints
-    if techniques.get(TechniqueKeys.NEGATIVE) and techniques.get(TechniqueKeys.NEGATIVE_DETAILS):
-        prompt_parts.append(f"**EXCLUDE:** {techniques[TechniqueKeys.NEGATIVE_DETAILS]}")
-        prompt_parts.append("")
-    
-    # Raw input/task
-    prompt_parts.append("**TASK:**")
-    prompt_parts.append(raw_input)
-    prompt_parts.append("")
-    
-    # Final instruction
-    prompt_parts.append("---")
-    prompt_parts.append("Based on the above specifications, create a clear, structured, and professional prompt.")
-    
-    return "\n".join(prompt_parts)
-
-def check_rate_limit() -> None:
-    """Ensure minimum time between API calls to prevent rate limiting."""
-    if 'last_api_call' not in st.session_state:
-        st.session_state.last_api_call = 0
-    
-    time_since_last = time.time() - st.session_state.last_api_call
-    if time_since_last < 1:  # Minimum 1 second between calls
-        time.sleep(1 - time_since_last)
-
-def update_api_call_time() -> None:
-    """Update the timestamp of the last API call."""
-    st.session_state.last_api_call = time.time()
-
-def export_history_as_json() -> str:
-    """Export prompt history as JSON string."""
-    if st.session_state.prompt_history:
-        return json.dumps(st.session_state.prompt_history, indent=2)
-    return json.dumps([])
+    # Sections are separated by a blank line; disabled ones are None
+    sections = (
+        # Base instruction
+        "Create an enhanced, professional prompt based on the following specifications:",
+        
+        # 1. Role Assignment
+        f"**ROLE/EXPERTISE:** {role_persona}"
+        if techniques.role else None,
+        
+        # 2. Context Setting
+        f"**CONTEXT:**\n{context_file_content}"
+        if techniques.context and context_file_content and context_file_content != "No external context file was provided." else None,
+        
+        # 3. Constraint & Format
+        f"**OUTPUT FORMAT:** {techniques.format_details}"
+        if techniques.format and techniques.format_details else None,
+        
+        # 4. Tone/Style
+        f"**TONE/STYLE:** {tone_style}",
+        
+        # 5. Chain of Thought
+        "**REASONING:** Show your step-by-step thought process and reasoning before providing the final answer."
+        if techniques.cot else None,
+        
+        # 6. Iteration & Critique (for refinement)
+        f"**REFINEMENT INSTRUCTIONS:** {techniques.iterate_instructions}"
+        if techniques.iterate and techniques.iterate_instructions else None,
+        
+        # 7. Negative Constraints
+        f"**EXCLUDE:** {techniques.negative_details}"
+        if techniques.negative and techniques.negative_details else None,
+        
+        # Raw input/task
+        f"**TASK:**\n{raw_input}",
+        
+        # Final instruction
+        "---\nBased on the above specifications, create a clear, structured, and professional prompt."
+    )
+    
+    return "\n\n".join(section for section in sections if section)
+
+def check_rate_limit(cost: int = 1) -> None:
+    """Token-bucket rate limit: about one API call per second, with short bursts.
+
+    Sleeps only when the bucket holds fewer than ``cost`` tokens.
+    """
+    now = time.monotonic()
+    elapsed = now - st.session_state.get('last_api_call', 0.0)
+    tokens = min(
+        RATE_LIMIT_BURST,
+        st.session_state.get('rate_limit_tokens', RATE_LIMIT_BURST) + elapsed * RATE_LIMIT_PER_SECOND
+    )
+    if tokens < cost:
+        time.sleep((cost - tokens) / RATE_LIMIT_PER_SECOND)
+        tokens = cost
+        now = time.monotonic()
+    st.session_state.rate_limit_tokens = tokens - cost
+    st.session_state.last_api_call = now
+
+def export_history_as_json() -> Union[bytes, str]:
+    """Export prompt history as JSON (bytes when orjson is available).
+
+    The result is kept in ``st.session_state.history_json`` until the history
+    changes, so reruns do not serialize it again.
+    """
+    if st.session_state.get('history_json') is None:
+        history = list(st.session_state.prompt_history)
+        if orjson is not None:
+            st.session_state.history_json = orjson.dumps(history, option=orjson.OPT_INDENT_2)
+        else:
+            st.session_state.history_json = json.dumps(history, indent=2)
+    return st.session_state.history_json
+
+def get_pyperclip() -> Optional[Any]:
+    """Import pyperclip on first use, at most once per session.
+
+    Returns ``None`` if it is not installed.
+    """
+    if '_pyperclip' not in st.session_state:
+        try:
+            import pyperclip
+            st.session_state._pyperclip = pyperclip
+        except ImportError:
+            st.session_state._pyperclip = None
+    return st.session_state._pyperclip
 
 # ============================================================================
 # SESSION STATE INITIALIZATION
 # ============================================================================
 
 if 'prompt_history' not in st.session_state:
-    st.session_state.prompt_history = []
+    # Newest first; only the last 5 prompts are kept
+    st.session_state.prompt_history = deque(maxlen=5)
+
+if 'history_json' not in st.session_state:
+    # Serialized export of prompt_history; None when it needs rebuilding
+    st.session_state.history_json = None
 
 if 'current_output' not in st.session_state:
     st.session_state.current_output = None
@@ -313,8 +496,15 @@ if 'selected_preset' not in st.session_state:
 if 'custom_presets' not in st.session_state:
     st.session_state.custom_presets = {}
 
+if 'all_presets' not in st.session_state:
+    # Default and custom presets combined; updated when a preset is saved
+    st.session_state.all_presets = {**PRESETS}
+
 if 'last_api_call' not in st.session_state:
-    st.session_state.last_api_call = 0
+    st.session_state.last_api_call = 0.0
+
+if 'rate_limit_tokens' not in st.session_state:
+    st.session_state.rate_limit_tokens = RATE_LIMIT_BURST
 
 # ============================================================================
 # PAGE CONFIGURATION
@@ -329,7 +519,15 @@ load_custom_css()
 # SIDEBAR - CONFIGURATION
 # ============================================================================
 
-with st.sidebar:
+@st.fragment
+def sidebar_config() -> None:
+    """Render the model and persona settings.
+
+    Runs as a fragment so that changing a setting reruns only this block.
+    The main content reads these values only when generating, from
+    ``st.session_state.sidebar_config``. The technique toggles stay outside
+    the fragment because the main content displays the active techniques.
+    """
     st.markdown("### ⚙️ Configuration")
     
     # Model selection
@@ -368,14 +566,31 @@ with st.sidebar:
         help="Specify the writing style"
     )
     
+    st.session_state.sidebar_config = SidebarConfig(
+        model_name=selected_model_name,
+        model_id=model_id,
+        temperature=temperature,
+        role_persona=role_persona,
+        tone_style=tone_style
+    )
+
+with st.sidebar:
+    sidebar_config()
+    
+    # Read the last committed settings from the sidebar fragment
+    sidebar_settings: SidebarConfig = st.session_state.sidebar_config
+    selected_model_name = sidebar_settings.model_name
+    model_id = sidebar_settings.model_id
+    temperature = sidebar_settings.temperature
+    role_persona = sidebar_settings.role_persona
+    tone_style = sidebar_settings.tone_style
+    
     st.markdown("---")
     
     st.markdown("### 🧠 Prompting Techniques")
     
-    # Combine default and custom presets
-    all_presets = {**PRESETS}
-    if st.session_state.custom_presets:
-        all_presets.update({f"⭐ {name}": PresetConfig(**config) for name, config in st.session_state.custom_presets.items()})
+    # Default and custom presets, combined once per change
+    all_presets = st.session_state.all_presets
     
     # Preset selector
     selected_preset = st.selectbox(
@@ -480,6 +695,7 @@ with st.sidebar:
                         TechniqueKeys.NEGATIVE: use_negative
                     }
                     st.session_state.custom_presets[preset_name] = custom_config
+                    st.session_state.all_presets[f"⭐ {preset_name}"] = PresetConfig(**custom_config)
                     st.success(f"✅ Saved preset: {preset_name}")
                     st.rerun()
                 else:
@@ -526,7 +742,8 @@ with st.sidebar:
     col1, col2 = st.columns(2)
     with col1:
         if st.button("🗑️ Clear History", use_container_width=True):
-            st.session_state.prompt_history = []
+            st.session_state.prompt_history.clear()
+            st.session_state.history_json = None
             st.session_state.current_output = None
             st.rerun()
     
@@ -551,49 +768,38 @@ with st.sidebar:
 st.markdown('<h1 class="main-header">✨ Universal Prompt Enhancer</h1>', unsafe_allow_html=True)
 st.markdown('<p class="subtitle">Transform raw ideas into structured, professional prompts using AI + Advanced Techniques</p>', unsafe_allow_html=True)
 
-# Show active techniques
-active_techniques = [k for k, v in techniques.items() if v and k not in [TechniqueKeys.FORMAT_DETAILS, TechniqueKeys.ITERATE_INSTRUCTIONS, TechniqueKeys.NEGATIVE_DETAILS]]
-if active_techniques:
+def render_active_techniques(active: Tuple[str, ...]) -> None:
+    """Show a badge for each enabled technique, three per row."""
+    if not active:
+        return
     st.markdown("**🔥 Active Techniques:**")
-    cols = st.columns(min(len(active_techniques), 3))
-    technique_names = {
-        TechniqueKeys.ROLE: '1️⃣ Role',
-        TechniqueKeys.COT: '2️⃣ Chain-of-Thought',
-        TechniqueKeys.FORMAT: '3️⃣ Format',
-        TechniqueKeys.CONTEXT: '4️⃣ Context',
-        TechniqueKeys.ITERATE: '5️⃣ Iteration',
-        TechniqueKeys.NEGATIVE: '6️⃣ Negative'
-    }
-    for idx, tech in enumerate(active_techniques):
+    cols = st.columns(min(len(active), 3))
+    for idx, tech in enumerate(active):
         with cols[idx % 3]:
-            st.markdown(f'<div class="technique-box">{technique_names.get(tech, tech)}</div>', unsafe_allow_html=True)
+            st.markdown(f'<div class="technique-box">{_TECHNIQUE_NAMES.get(tech, tech)}</div>', unsafe_allow_html=True)
     st.markdown("")
 
+# Show active techniques
+active_techniques = [k for k, v in techniques.items() if v and k not in _DETAIL_KEYS]
+render_active_techniques(tuple(active_techniques))
+
 # Example prompts
 with st.expander("💡 See Example Prompts"):
     col1, col2 = st.columns(2)
     
     with col1:
-        st.markdown('<div class="example-box">', unsafe_allow_html=True)
-        st.markdown("**Marketing Email**")
+        st.markdown('<div class="example-box"><strong>Marketing Email</strong></div>', unsafe_allow_html=True)
         st.code("Write an email about our new product launch targeting enterprise customers", language="text")
-        st.markdown('</div>', unsafe_allow_html=True)
         
-        st.markdown('<div class="example-box">', unsafe_allow_html=True)
-        st.markdown("**Technical Doc**")
+        st.markdown('<div class="example-box"><strong>Technical Doc</strong></div>', unsafe_allow_html=True)
         st.code("Create API documentation for our authentication endpoints", language="text")
-        st.markdown('</div>', unsafe_allow_html=True)
     
     with col2:
-        st.markdown('<div class="example-box">', unsafe_allow_html=True)
-        st.markdown("**Social Media**")
+        st.markdown('<div class="example-box"><strong>Social Media</strong></div>', unsafe_allow_html=True)
         st.code("Draft LinkedIn post about AI trends for technology leaders", language="text")
-        st.markdown('</div>', unsafe_allow_html=True)
         
-        st.markdown('<div class="example-box">', unsafe_allow_html=True)
-        st.markdown("**Content Brief**")
+        st.markdown('<div class="example-box"><strong>Content Brief</strong></div>', unsafe_allow_html=True)
         st.code("Outline a blog post about sustainable business practices", language="text")
-        st.markdown('</div>', unsafe_allow_html=True)
 
 st.markdown("### 📝 Enter Your Raw Prompt")
 
@@ -609,11 +815,13 @@ raw_input = st.text_area(
 if raw_input:
     char_count = len(raw_input)
     word_count = len(raw_input.split())
-    col1, col2, col3 = st.columns([1, 1, 3])
-    with col1:
-        st.markdown(f'<div class="stat-box">📊 {char_count} characters</div>', unsafe_allow_html=True)
-    with col2:
-        st.markdown(f'<div class="stat-box">📝 {word_count} words</div>', unsafe_allow_html=True)
+    st.markdown(
+        '<div class="stat-row">'
+        f'<div class="stat-box">📊 {char_count} characters</div>'
+        f'<div class="stat-box">📝 {word_count} words</div>'
+        '</div>',
+        unsafe_allow_html=True
+    )
 
 st.markdown("")
 
@@ -628,11 +836,15 @@ with col2:
 # GENERATION LOGIC
 # ============================================================================
 
-def generate_prompt(temp_override: Optional[float] = None) -> None:
-    """Generate a single enhanced prompt."""
+def prepare_request() -> Optional[Tuple[str, str]]:
+    """Validate the raw input and build the full prompt sent to Gemini.
+
+    Returns a ``(sanitized_input, full_prompt)`` tuple, or ``None`` if there
+    is nothing to enhance.
+    """
     if not raw_input:
         st.error("⚠️ Please enter some raw input to enhance.")
-        return
+        return None
     
     # Sanitize input
     sanitized_input = sanitize_input(raw_input)
@@ -640,12 +852,8 @@ def generate_prompt(temp_override: Optional[float] = None) -> None:
     # Load context file content
     context_file_content = "No external context file was provided."
     if context_file is not None:
-        try:
-            context_file_content = context_file.read().decode("utf-8")
-        except Exception as e:
-            logger.error(f"Error reading context file: {e}")
-            st.warning(f"Could not read context file: {e}")
-            context_file_content = "Error reading context file."
+        # Undecodable bytes are replaced, so reading the upload cannot fail
+        context_file_content = _read_context(context_file.getvalue())
     
     # Build the enhanced prompt using selected techniques
     full_prompt = build_enhanced_prompt(
@@ -655,71 +863,154 @@ def generate_prompt(temp_override: Optional[float] = None) -> None:
         tone_style, 
         context_file_content
     )
+    return sanitized_input, full_prompt
+
+def record_output(sanitized_input: str, output: str, temp: float) -> None:
+    """Store a generated prompt as the current output and in the history."""
+    st.session_state.current_output = output
+    st.session_state.prompt_history.appendleft({
+        'input': sanitized_input,
+        'output': output,
+        'model': selected_model_name,
+        'techniques': [t for t in active_techniques],
+        'temperature': temp
+    })
+    st.session_state.history_json = None
+
+def show_api_error(e: Exception) -> None:
+    """Log and display an error raised by a Gemini API call."""
+    if isinstance(e, ClientError):
+        logger.error(f"API Error: {str(e)}")
+        st.error("❌ **API Error: Invalid API Key or Request**")
+        st.error(f"**Details:** {str(e)}")
+        st.info("💡 Please verify your API key configuration.")
+    else:
+        logger.error(f"Unexpected error: {str(e)}")
+        st.error("❌ **An error occurred while calling the Gemini API**")
+        st.exception(e)
+
+def is_candidate_count_unsupported(e: ClientError) -> bool:
+    """Return True if the multi-candidate request may have been rejected for
+    its ``candidate_count``.
+
+    Gemini's wording for this varies by model (e.g. "Multiple candidates is
+    not enabled for models/..."), so any 400 INVALID_ARGUMENT from that call
+    triggers the fallback. Other client errors (bad key, quota) would fail
+    the per-temperature requests just the same, so they are not retried.
+    """
+    return (
+        getattr(e, 'code', None) == 400
+        and getattr(e, 'status', None) == 'INVALID_ARGUMENT'
+    )
+
+def generate_prompt() -> None:
+    """Generate a single enhanced prompt."""
+    request = prepare_request()
+    if request is None:
+        return
+    sanitized_input, full_prompt = request
+    
+    # Identical requests are answered from the cache without calling the API
+    cached_output = get_cached_response(model_id, full_prompt, temperature)
+    if cached_output is not None:
+        logger.info(f"Cache hit - Model: {model_id}, Temperature: {temperature}")
+        record_output(sanitized_input, cached_output, temperature)
+        return
     
     # Check rate limiting
     check_rate_limit()
     
-    # Show loading spinner
+    # Stream tokens into a placeholder; the final output is rendered below
+    stream_placeholder = st.empty()
     with st.spinner("🤖 Enhancing your prompt with Gemini AI..."):
         try:
             # Call Gemini API
-            actual_temp = temp_override if temp_override is not None else temperature
-            logger.info(f"API call - Model: {model_id}, Temperature: {actual_temp}")
+            logger.info(f"API call - Model: {model_id}, Temperature: {temperature}")
             
-            response = client.models.generate_content(
-                model=model_id,
-                contents=full_prompt,
-                config={'temperature': actual_temp}
-            )
+            with stream_placeholder.container():
+                output = st.write_stream(_stream_gemini(full_prompt, model_id, temperature))
             
-            # Update rate limit tracker
-            update_api_call_time()
+            # An empty stream (e.g. a safety block) is neither cached nor saved
+            if not isinstance(output, str) or not output:
+                logger.warning("Gemini returned an empty response")
+                st.warning("⚠️ Gemini returned an empty response. Try rephrasing your prompt.")
+                return
             
             # Store in session state
-            st.session_state.current_output = response.text
-            st.session_state.prompt_history.insert(0, {
-                'input': sanitized_input,
-                'output': response.text,
-                'model': selected_model_name,
-                'techniques': [t for t in active_techniques],
-                'temperature': actual_temp
-            })
-            
-            # Keep only last 5 prompts
-            if len(st.session_state.prompt_history) > 5:
-                st.session_state.prompt_history = st.session_state.prompt_history[:5]
+            cache_response(model_id, full_prompt, temperature, output)
+            record_output(sanitized_input, output, temperature)
             
             logger.info("Successfully generated prompt")
             
+        except Exception as e:
+            show_api_error(e)
+        
+        finally:
+            stream_placeholder.empty()
+
+def fan_out_variations(full_prompt: str) -> Tuple[List[Tuple[float, str]], List[BaseException]]:
+    """Generate one variation per temperature using concurrent requests.
+
+    Used when the selected model does not accept ``candidate_count``.
+    """
+    results = asyncio.run(_gather_gemini(full_prompt, model_id, VARIATION_TEMPERATURES))
+    variations: List[Tuple[float, str]] = []
+    errors: List[BaseException] = []
+    for temp_value, result in zip(VARIATION_TEMPERATURES, results):
+        if isinstance(result, BaseException):
+            errors.append(result)
+        elif result:
+            # Blocked or empty responses are skipped, as for candidates
+            variations.append((temp_value, result))
+    return variations, errors
+
+def generate_variations() -> None:
+    """Generate three enhanced prompt variations in a single request."""
+    request = prepare_request()
+    if request is None:
+        return
+    sanitized_input, full_prompt = request
+    
+    st.markdown("### 🔄 Generated Variations")
+    st.caption("Three variations sampled from the same prompt")
+    
+    check_rate_limit()
+    
+    variations: List[Tuple[float, str]] = []
+    errors: List[BaseException] = []
+    with st.spinner("🤖 Generating variations with Gemini AI..."):
+        try:
+            logger.info(f"API call - Model: {model_id}, Temperature: {temperature}, Candidates: {len(VARIATION_TEMPERATURES)}")
+            candidates = _call_gemini_candidates(full_prompt, model_id, temperature, len(VARIATION_TEMPERATURES))
+            variations = [(temperature, text) for text in candidates]
         except ClientError as e:
-            logger.error(f"API Error: {str(e)}")
-            st.error("❌ **API Error: Invalid API Key or Request**")
-            st.error(f"**Details:** {str(e)}")
-            st.info("💡 Please verify your API key configuration.")
-            
+            if not is_candidate_count_unsupported(e):
+                errors.append(e)
+            else:
+                # Not every model supports multiple candidates per request
+                logger.warning(f"Multi-candidate request rejected, falling back to one request per temperature: {e}")
+                check_rate_limit(len(VARIATION_TEMPERATURES))
+                variations, errors = fan_out_variations(full_prompt)
         except Exception as e:
-            logger.error(f"Unexpected error: {str(e)}")
-            st.error("❌ **An error occurred while calling the Gemini API**")
-            st.exception(e)
+            errors.append(e)
+    
+    # The requests usually fail for the same reason, so report only the first
+    if errors:
+        show_api_error(errors[0])
+    
+    for i, (temp_value, output) in enumerate(variations):
+        record_output(sanitized_input, output, temp_value)
+        with st.expander(f"Variation {i+1} (Temperature: {temp_value})", expanded=False):
+            st.code(output, language='markdown')
+    
+    if variations:
+        logger.info(f"Successfully generated {len(variations)} variations")
 
 if generate_btn:
     generate_prompt()
 
 if generate_variations_btn:
-    if not raw_input:
-        st.error("⚠️ Please enter some raw input to enhance.")
-    else:
-        st.markdown("### 🔄 Generated Variations")
-        st.caption("Three variations with different creativity levels")
-        
-        variations_container = st.container()
-        
-        with variations_container:
-            for i, temp_value in enumerate([0.7, 1.0, 1.5]):
-                with st.expander(f"Variation {i+1} (Temperature: {temp_value})", expanded=False):
-                    generate_prompt(temp_override=temp_value)
-                    if st.session_state.current_output:
-                        st.code(st.session_state.current_output, language='markdown')
+    generate_variations()
 
 # ============================================================================
 # OUTPUT DISPLAY
@@ -746,14 +1037,15 @@ if st.session_state.current_output:
     
     with col2:
         if st.button("📋 Copy to Clipboard", use_container_width=True):
-            try:
-                import pyperclip
-                pyperclip.copy(st.session_state.current_output)
-                st.toast("Copied to clipboard! 📋", icon="✅")
-            except ImportError:
+            pyperclip = get_pyperclip()
+            if pyperclip is None:
                 st.info("💡 Install pyperclip for clipboard support: pip install pyperclip")
-            except Exception:
-                st.info("💡 Please manually select and copy the text above")
+            else:
+                try:
+                    pyperclip.copy(st.session_state.current_output)
+                    st.toast("Copied to clipboard! 📋", icon="✅")
+                except Exception:
+                    st.info("💡 Please manually select and copy the text above")
 
 # ============================================================================
 # PROMPT HISTORY